@@ -7,118 +7,372 @@
 
 """
 This is a simple command line based password manager which stores users password in
-an ecrypted database. The database is organized as a CSV file with the schema defined
-by _SCHEMA. The DB is encrypted using user's password and a random salt. The salt is
-regenerated for every database update.
+an ecrypted database. The database is organized as a table with the schema defined
+by _SCHEMA and stored as a JSON document, serialized by orjson when it is installed;
+databases stored as CSV by earlier versions are still read. The DB is encrypted using
+user's password and a random salt. The salt is kept across updates of the database so
+that the password is stretched only once per session; every update is encrypted with
+a fresh nonce. Updated records are appended to an encrypted journal next to the
+database which is folded back into the database once it grows past _JOURNAL_LIMIT
+records.
 
 """
 
 import argparse
+import array
+import bisect
 import csv
 import datetime
+import functools
 import getpass
+import itertools
+import operator
 import os
-import pprint
 import re
-import shutil
+import struct
 import sys
-import urllib.parse
-
-import cryptography.fernet
+import types
 
 import CryptIOBroker
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 #PRIVATEDB = '~/Documents/encfsdata.d'
 #PRIVATEDIR = '~/Private'
 PRIVATEDIR = '/tmp'
 
+# An org name free of these is a plain string which needs no regex engine
+_REGEX_META = frozenset('.^$*+?{}[]\\|()\n')
+# Anchors to the whole string and lookarounds see the neighbouring records in the org
+# blob, patterns using them are searched record by record
+_CONTEXT_SENSITIVE = re.compile(r'\\[AZz]|\(\?<?[=!]')
+
+def _dump_table(schema, rows):
+    """ Serialize the schema and the rows into a JSON document as UTF-8 bytes """
+    document = {'schema': schema, 'rows': rows}
+    if (orjson):
+        return orjson.dumps(document)
+    import json
+    return json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _load_table(data):
+    """ Parse the JSON document in the UTF-8 bytes """
+    if (orjson):
+        return orjson.loads(data)
+    import json
+    return json.loads(data)
+
+@functools.cache
+def _re2():
+    """ Import RE2 on first use, only regex lookups need it; None if it is not installed """
+    try:
+        import re2
+        return re2
+    except ImportError:
+        return None
+
+@functools.lru_cache(maxsize=128)
+def _compile_icase(org_name, allow_re2):
+    """
+    Compile the org name pattern case insensitively with ^ and $ matching at every line.
+    RE2 matches in linear time regardless of the user supplied pattern, so it is preferred
+    when allowed. Its character classes are ASCII only and it reads {,n} literally, hence
+    it is restricted to ASCII patterns without {,n}; patterns it rejects, e.g.
+    backreferences, use re. Memoized since repeated lookups reuse the same pattern.
+    """
+    if (allow_re2 and org_name.isascii() and '{,' not in org_name):
+        re2 = _re2()
+        options = re2.Options()
+        options.case_sensitive = False
+        options.log_errors = False
+        try:
+            return re2.compile(f'(?m){org_name}'.encode('ascii'), options)
+        except re2.error:
+            pass
+    return re.compile(org_name, re.IGNORECASE | re.MULTILINE)
+
 class PasswordManager:
     """
-    A simple command line based password manager. The passwords are stored in a CSV file
+    A simple command line based password manager. The passwords are stored in a table
     with the schema defined by _SCHEMA.
     TODO: Support for encrypting the password file
     """
-    _SCHEMA = ['ORGANIZATION', 'URL', 'USERID', 'PASSWD', 'OTHERID1', 'OTHERID2', 'DATE',
-               'KIND', 'NOTES']
+    _SCHEMA = ('ORGANIZATION', 'URL', 'USERID', 'PASSWD', 'OTHERID1', 'OTHERID2', 'DATE',
+               'KIND', 'NOTES')
+    # Records are lists in _SCHEMA order, fields are addressed through this shared index
+    _SCHEMA_IDX = {key: field for field, key in enumerate(_SCHEMA)}
+    _ORGANIZATION = _SCHEMA_IDX['ORGANIZATION']
+    _DATE = _SCHEMA_IDX['DATE']
+    # Template for new records, copied rather than built field by field
+    _EMPTY_ROW = ['None'] * len(_SCHEMA)
     _PASSDB = 'password.db'
+    _BASE, _EXT = os.path.splitext(_PASSDB)
     _BACKUPDIR = 'backup.d'
+    _JOURNAL_EXT = '.jrn'
+    _JOURNAL_LIMIT = 64
 
     def load_database(self):
         """ Initialize the in memory database by reading from database file """
         broker = CryptIOBroker.CryptIOBroker(self._password, 'r', self._db_file_name)
-        reader = csv.DictReader(broker, delimiter=',', quoting=csv.QUOTE_MINIMAL)
-        assert(reader.fieldnames == PasswordManager._SCHEMA)
-        for row in reader:
-            self._password_table.append(row)
+        # Records are kept as plain lists in _SCHEMA order, a dict is only built for display
+        # getvalue() hands out the bytes held by the BytesIO, getbuffer() would copy them
+        contents = broker.buffer.getvalue()
+        document = _load_table(contents) if (contents[:1] == b'{') else None
+        if (document is not None):
+            assert(tuple(document['schema']) == PasswordManager._SCHEMA)
+            self._password_table.extend(document['rows'])
+        else:
+            # Databases written before the switch to JSON hold CSV
+            reader = csv.reader(broker, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+            assert(tuple(next(reader, ())) == PasswordManager._SCHEMA)
+            self._password_table.extend(reader)
+        self._kdf_params = broker.kdf_params()
+        self._database_id = broker.database_id()
+        broker.close()
+        # A database in the legacy layout has no id for a journal to refer to, the next
+        # update writes it out in full
+        if (self._database_id is None):
+            self._compact = True
+        self._replay_journal()
+
+    def _replay_journal(self):
+        """ Apply the records updated since the database was last written out from the journal """
+        journal = self._journal_file_name
+        # The database opened with this password already, a journal failing to do so is
+        # damaged or belongs to another database
+        hint = "move it aside to open the database without it"
+        try:
+            broker = CryptIOBroker.CryptIOBroker(self._password, 'r', journal)
+        except(FileNotFoundError):
+            return
+        except(CryptIOBroker.InvalidToken, RuntimeError, struct.error) as jerr:
+            raise (RuntimeError(f"Journal {journal} is damaged or does not belong to database "
+                                f"{self._db_file_name}; {hint}")) from jerr
+        # Every full write gives the database a new id, a journal left over from before it,
+        # e.g. when the database is restored from a backup, would undo the write
+        if (broker.database_id() not in (None, self._database_id)):
+            broker.close()
+            raise (RuntimeError(f"Journal {journal} extends another version of database "
+                                f"{self._db_file_name}, e.g. one restored from a backup; {hint}"))
+        # Journal records are prefixed with their index, the latest copy of a record wins
+        for record in csv.reader(broker, delimiter=',', quoting=csv.QUOTE_MINIMAL):
+            if (len(record) != len(PasswordManager._SCHEMA) + 1 or not record[0].isdigit()):
+                raise (RuntimeError(f"Journal {journal} holds a malformed record; {hint}"))
+            index = int(record[0])
+            if (index > len(self._password_table)):
+                raise (RuntimeError(f"Journal {journal} updates record {index} past the end of "
+                                    f"database {self._db_file_name}; {hint}"))
+            if (index == len(self._password_table)):
+                self._password_table.append(record[1:])
+            else:
+                self._password_table[index] = record[1:]
+            self._journal_len += 1
+        # Anything appended after a partial record would be lost, start over from the database
+        if (broker.truncated()):
+            self._compact = True
         broker.close()
 
-    def __init__(self, password, root_dir = PRIVATEDIR):
-        """ PasswordManager class constructor """
+    def __init__(self, password, root_dir = PRIVATEDIR, kdf = None):
+        """
+        PasswordManager class constructor. kdf picks the key derivation function for a
+        new database; an existing database is switched over to it on its next update.
+        """
         self._password = password
-        self._db_file_name = f'{root_dir}/{PasswordManager._PASSDB}'
-        self._pretty = pprint.PrettyPrinter(indent=4, sort_dicts=False)
+        self._db_file_name = os.path.join(root_dir, PasswordManager._PASSDB)
         print(f"Using database file {self._db_file_name}...")
         self._password_table = []
+        self._kdf_params = {'kdf': kdf} if kdf else {}
+        self._database_id = None
+        self._org_blob = None
+        self._org_bytes = None
+        self._org_lower = None
+        self._org_offsets = None
         self._dirty = False
-        self._backup_dir = os.path.dirname(self._db_file_name)
-        self._backup_dir += f'/{PasswordManager._BACKUPDIR}'
+        self._journal_file_name = f'{self._db_file_name}{PasswordManager._JOURNAL_EXT}'
+        self._journal_rows = set()
+        self._journal_len = 0
+        self._compact = False
+        self._backup_dir = os.path.join(root_dir, PasswordManager._BACKUPDIR)
 
         try:
             self.load_database()
         except(FileNotFoundError) as ferr:
             print(f"Database {self._db_file_name} not found, creating empty database...")
             self.write_updated_table()
-        except(cryptography.fernet.InvalidToken ) as ierr:
+        except(CryptIOBroker.InvalidToken) as ierr:
             print(f"Invalid password for database {self._db_file_name}, exiting")
             raise(ierr)
         except Exception as eerr:
             raise(eerr)
+        # A fresh salt is drawn when moving over to a different key derivation function
+        if (kdf and self._kdf_params['kdf'] != kdf):
+            self._kdf_params = {'kdf': kdf}
+            self._compact = True
+            print(f"Database {self._db_file_name} switches over to {kdf} on its next update or compaction")
         print(f"Total {len(self._password_table)} records found")
 
-    def _get_backup_csv_file_name(self):
-        """ Generate date indexed CSV file name to backup the database """
-        base_ext = os.path.splitext(PasswordManager._PASSDB)
-        csv_backup_file_name = self._backup_dir
-        csv_backup_file_name += f'/{base_ext[0]}'
-        csv_backup_file_name += '.'
-        csv_backup_file_name += datetime.date.today().isoformat()
-        csv_backup_file_name += f'{base_ext[1]}'
-        return csv_backup_file_name
+    def _get_backup_file_name(self):
+        """ Generate date indexed file name to backup the database """
+        today = datetime.date.today().isoformat()
+        return os.path.join(self._backup_dir,
+                            f'{PasswordManager._BASE}.{today}{PasswordManager._EXT}')
+
+    def _format_rows(self, rows):
+        """
+        Format the rows as CSV text in one go. A row without commas, quotes or line breaks
+        needs no quoting under csv.QUOTE_MINIMAL and is simply joined; only the rest go
+        through the csv writer, which appends to the same list of lines.
+        """
+        lines = []
+        writer = csv.writer(types.SimpleNamespace(write=lines.append), delimiter=',',
+                            quoting=csv.QUOTE_MINIMAL)
+        for row in rows:
+            line = ','.join(row)
+            if (line.count(',') != len(row) - 1 or '"' in line or '\n' in line or '\r' in line):
+                writer.writerow(row)
+            else:
+                lines.append(line + writer.dialect.lineterminator)
+        return ''.join(lines)
+
+    def _write_table(self, file_name):
+        """ Encrypt the table into the file and return the id the database was written with """
+        # Reuse the salt of the database so the key memoized when loading it applies
+        broker = CryptIOBroker.CryptIOBroker(self._password, 'w', file_name, **self._kdf_params)
+        self._kdf_params = broker.kdf_params()
+        # The document is UTF-8 already, hand it to the byte buffer under the text layer
+        broker.buffer.write(_dump_table(PasswordManager._SCHEMA, self._password_table))
+        broker.close()
+        return broker.database_id()
 
     def write_updated_table(self):
-        """ Write out the updated database to the CSV file """
-        broker = CryptIOBroker.CryptIOBroker(self._password, 'w', self._db_file_name)
-        writer = csv.DictWriter(broker, PasswordManager._SCHEMA,
-                                restval = None, delimiter=',', quoting=csv.QUOTE_MINIMAL)
-        writer.writeheader()
-        for row in self._password_table:
-            writer.writerow(row)
-        print(f"Committed {len(self._password_table)} records to the CSV file {self._db_file_name}")
+        """ Write out the updated database to the database file """
+        # The journal is tied to the database by its id, which changes with every write
+        self._database_id = self._write_table(self._db_file_name)
+        print(f"Committed {len(self._password_table)} records to the database file {self._db_file_name}")
+        # The journal is folded into the database now
+        try:
+            os.unlink(self._journal_file_name)
+        except(FileNotFoundError):
+            pass
+        self._journal_rows.clear()
+        self._journal_len = 0
+        self._compact = False
+
+    def commit_updates(self, compact = False):
+        """
+        Commit the updated records. They are appended to the journal as a single encrypted
+        record rather than rewriting the whole database, which only happens when compacting
+        or once the journal would grow past _JOURNAL_LIMIT records.
+        """
+        if (compact or self._compact or
+            self._journal_len + len(self._journal_rows) > PasswordManager._JOURNAL_LIMIT):
+            self.write_updated_table()
+            return
+        if (len(self._journal_rows) == 0):
+            return
+        # In index order so that new records are replayed in the order they were appended
+        rows = [[str(index)] + self._password_table[index] for index in sorted(self._journal_rows)]
+        broker = CryptIOBroker.CryptIOBroker(self._password, 'a', self._journal_file_name,
+                                             database_id=self._database_id, **self._kdf_params)
+        broker.write(self._format_rows(rows))
+        print(f"Journaled {len(rows)} records to {self._journal_file_name}")
         broker.close()
+        self._journal_len += len(rows)
+        self._journal_rows.clear()
 
-    def extract_record(self, org_name):
-        """ Look up the record indices with matching org name """
-        pattern = re.compile(org_name, re.IGNORECASE)
-        org_list = []
-        index = 0
-        for row in self._password_table:
-            if (pattern.search(row['ORGANIZATION'])):
+    def _index_organizations(self):
+        """ Join all org names into a newline separated blob along with the offset of each """
+        orgs = list(map(operator.itemgetter(PasswordManager._ORGANIZATION), self._password_table))
+        self._org_blob = '\n'.join(orgs)
+        # Packed machine integers rather than a list of int objects, one per record
+        self._org_offsets = array.array('q', [0])
+        self._org_offsets.extend(itertools.accumulate(len(org) + 1 for org in orgs))
+        self._org_bytes = None
+        # str.lower() agrees with case insensitive matching and keeps the offsets intact
+        # only for ASCII, other blobs are always scanned with the regex
+        self._org_lower = None
+        if (self._org_blob.isascii()):
+            self._org_lower = self._org_blob.lower()
+
+    def _compile_org_pattern(self, org_name):
+        """ Compile the org name pattern and pick the blob it scans, bytes for RE2 """
+        pattern = _compile_icase(org_name, self._org_lower is not None and _re2() is not None)
+        if (isinstance(pattern, re.Pattern)):
+            return pattern, self._org_blob
+        # RE2 is handed bytes, its str interface re-encodes the whole blob on every search
+        if (self._org_bytes is None):
+            self._org_bytes = self._org_blob.encode('ascii')
+        return pattern, self._org_bytes
+
+    def _find_literal(self, needle):
+        """ Look up the record indices whose lowercased org name contains the lowercase needle """
+        org_list = array.array('q')
+        pos = self._org_lower.find(needle)
+        while (pos >= 0):
+            index = bisect.bisect_right(self._org_offsets, pos) - 1
+            org_list.append(index)
+            # Skip the rest of this record, one hit is enough
+            pos = self._org_lower.find(needle, self._org_offsets[index + 1])
+        return org_list
+
+    def extract_record(self, org_name, is_regex = False):
+        """
+        Look up the record indices with org name containing org_name, ignoring case. With
+        is_regex org_name is taken as a regular expression instead of a plain string. The
+        indices are returned packed in an array.array.
+        """
+        if (len(self._password_table) == 0):
+            return array.array('q')
+        if (self._org_blob is None):
+            self._index_organizations()
+        # Plain strings are looked up with a substring search of the lowercased blob. Beyond
+        # ASCII, case folding and re.IGNORECASE disagree, e.g. on 'ß' or 'İ', so anything
+        # else goes through the regex like a --regex pattern does
+        if (self._org_lower is not None and org_name.isascii() and '\n' not in org_name and
+            (not is_regex or _REGEX_META.isdisjoint(org_name))):
+            return self._find_literal(org_name.lower())
+        if (not is_regex):
+            org_name = re.escape(org_name)
+        pattern, blob = self._compile_org_pattern(org_name)
+        offsets = self._org_offsets
+        if (_CONTEXT_SENSITIVE.search(org_name)):
+            return array.array('q', (index for index in range(len(self._password_table))
+                                     if pattern.search(blob[offsets[index]:offsets[index + 1] - 1])))
+        # Scan the blob in one go instead of searching every record separately
+        org_list = array.array('q')
+        pos = 0
+        # search() clamps pos to the end of the blob, so stop once past the last record
+        while (pos <= len(blob)):
+            match = pattern.search(blob, pos)
+            if (match is None):
+                break
+            index = bisect.bisect_right(offsets, match.start()) - 1
+            start = offsets[index]
+            end = offsets[index + 1] - 1
+            # A match spilling into the following records may hide one within this record
+            if (match.end() <= end or pattern.search(blob[start:end])):
                 org_list.append(index)
-            index += 1
+            pos = end + 1
         return org_list
 
     def _ask_user_and_update_record(self, index):
         """ Ask the user to provide updated fields for the specified record """
+        # Only needed on the update path, keep it off the startup path of plain lookups
+        import urllib.parse
+
         row = self._password_table[index]
         response = "no"
         self.print_record(index)
-        response = input(f"Update record INDEX {index} for organization {row['ORGANIZATION']} [yes/no]? ")
+        response = input(f"Update record INDEX {index} for organization {row[PasswordManager._ORGANIZATION]} [yes/no]? ")
         if (response == "no"):
             return
         response = "no"
         while (response != "yes"):
-            for key in list(row):
-                prompt = f"{key}: [{row[key]}] "
+            for field, key in enumerate(PasswordManager._SCHEMA):
+                prompt = f"{key}: [{row[field]}] "
                 match key:
                     case 'URL':
                         value = input(prompt)
@@ -130,48 +384,63 @@ class PasswordManager:
                         value = input(prompt)
 
                 if (len(value)):
-                    row[key] = value
+                    row[field] = value
                     self._dirty = True
+                    self._journal_rows.add(index)
+                    if (field == PasswordManager._ORGANIZATION):
+                        self._org_blob = None
 
             self.print_record(index)
             response = input("Commit the above to the database? [yes/no] ")
 
-    def update_matching_orgs(self, org_name):
+    def update_matching_orgs(self, org_name, is_regex = False):
         """ Either update an exisiting record or create a new record and commit to the database """
-        org_list = self.extract_record(org_name)
+        org_list = self.extract_record(org_name, is_regex)
         row = None
         if (len(org_list) == 0):
             # No existing record found, create a placeholder"
-            values = ['None'] * len(PasswordManager._SCHEMA)
-            row = dict((zip(PasswordManager._SCHEMA, values)))
-            row['ORGANIZATION'] = org_name
-            row['DATE'] = datetime.date.today().isoformat()
+            row = PasswordManager._EMPTY_ROW.copy()
+            row[PasswordManager._ORGANIZATION] = org_name
+            row[PasswordManager._DATE] = datetime.date.today().isoformat()
             org_list.append(len(self._password_table))
+            self._journal_rows.add(len(self._password_table))
             self._password_table.append(row)
+            self._org_blob = None
 
         for index in org_list:
             self._ask_user_and_update_record(index)
 
     def print_record(self, index):
         """ Present the record to the user """
+        import json
+
         print(f"INDEX[{index}]")
-        row = self._password_table[index]
-        self._pretty.pprint(row)
+        row = dict(zip(PasswordManager._SCHEMA, self._password_table[index]))
+        print(json.dumps(row, indent=4, ensure_ascii=False))
 
     def backup(self):
-        """ Backup the database to a date indexed backup copy """
-        new_csv_file_name = self._get_backup_csv_file_name()
+        """ Backup the database with the updates in its journal folded in to a date indexed copy """
+        new_backup_file_name = self._get_backup_file_name()
         os.makedirs(self._backup_dir, exist_ok = True)
-        shutil.copyfile(self._db_file_name, new_csv_file_name)
-        print(f"Backed up the database to CSV file {new_csv_file_name}")
+        # The backup is written out afresh rather than linked or copied. It gets an id of its
+        # own, so a journal of updates made after the backup is refused once the backup is
+        # restored over the database, instead of being replayed onto it
+        self._write_table(new_backup_file_name)
+        print(f"Backed up the database to {new_backup_file_name}")
 
 def parse_command_line(args):
     """ Command line parsing helper routine """
     msg = "Lookup (and or update) the password for the organization requested"
     parser = argparse.ArgumentParser(description = msg, exit_on_error = False)
-    parser.add_argument('-o', '--org', dest = 'oname', nargs = 1, required=True)
+    # The built-in selftest is run on request only, it costs a key derivation
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('-o', '--org', dest = 'oname', nargs = 1)
+    action.add_argument('-s', '--selftest', dest = 'selftest', action='store_true')
+    parser.add_argument('-x', '--regex', dest = 'regex', action='store_true')
     parser.add_argument('-u', '--update', dest = 'update', action='store_true')
     parser.add_argument('-r', '--root', dest ='rname', nargs = 1)
+    parser.add_argument('-c', '--compact', dest = 'compact', action='store_true')
+    parser.add_argument('-k', '--kdf', dest = 'kdf', choices = ('pbkdf2', 'argon2id', 'scrypt'))
     # strip out the argv[0]
     return parser.parse_args(args[1:])
 
@@ -179,21 +448,32 @@ def parse_command_line(args):
 def main(args):
     """ Main entry point """
     try:
-        CryptIOBroker.CryptIOBroker.selftest()
         argtab = parse_command_line(args)
+        if (argtab.selftest):
+            CryptIOBroker.CryptIOBroker.selftest()
+            return 0
+        # Compile the org name up front so that a malformed pattern is reported before the
+        # password is asked for and stretched. RE2 is allowed as for a lookup, so only a
+        # pattern rejected by every engine is reported and the memoized pattern is reused
+        if (argtab.regex):
+            _compile_icase(argtab.oname[0], _re2() is not None)
         pman = None
         value = getpass.getpass("Password: ")
         if (argtab.rname):
-            pman = PasswordManager(value, argtab.rname[0])
+            pman = PasswordManager(value, argtab.rname[0], argtab.kdf)
         else:
-            pman = PasswordManager(value)
-        indexes = pman.extract_record(argtab.oname[0])
+            pman = PasswordManager(value, kdf = argtab.kdf)
+        indexes = pman.extract_record(argtab.oname[0], argtab.regex)
         for index in indexes:
             pman.print_record(index)
 
         if (argtab.update):
             pman.backup()
-            pman.update_matching_orgs(argtab.oname[0])
+            pman.update_matching_orgs(argtab.oname[0], argtab.regex)
+            pman.commit_updates(argtab.compact)
+        elif (argtab.compact):
+            # Compacting rewrites the database, possibly under a new key, back it up first
+            pman.backup()
             pman.write_updated_table()
         return 0
 